@@ -26,12 +26,12 @@ setup(
     packages=["wgrabber"],
     include_package_data=True,
     install_requires=[
-        "beautifulsoup4==4.5.3",
         "requests==2.20.0",
         "lxml==4.6.2",
         "Click==7.1.2",
         "Pillow==7.1.0",
     ],
+    extras_require={"brotli": ["brotli"], "cache": ["requests-cache"]},
     setup_requires=['pytest-runner', 'flake8', 'pylint', 'black'],
     tests_require=[
         'pytest', 'coverage', 'pytest-cov'
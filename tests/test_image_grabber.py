@@ -0,0 +1,621 @@
+import json
+import time
+import zipfile
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+import requests
+from PIL import Image
+from urllib3 import HTTPResponse
+
+from wgrabber import image_grabber
+from wgrabber.image_grabber import (
+    ImageGrabber,
+    _backoff,
+    _Connection,
+    _RateLimiter,
+    _retry_after,
+    batch_download,
+)
+
+START_URL = "https://www.example.org/photos-index-aid-1.html"
+# an album page without any charset, neither in the headers nor in a meta tag
+INDEX_PAGE = """<html><body>
+<div class="png bread"><a href="/">首頁</a><a href="/c">同人誌</a><a href="/l">漢化</a></div>
+<h2> 標題 </h2><label>頁數：24P</label>
+<div class="pic_box tb"><a href="/photos-view-id-1.html"><img src="1"/></a></div>
+<div class="pic_box tb"><a href="/photos-view-id-24.html"><img src="24"/></a></div>
+</body></html>"""
+VIEW_PAGE = b'<html><body><img id="picarea" src="//img/data/0024.jpg"/></body></html>'
+
+
+def _image_bytes(fmt):
+    """
+    Encode a tiny image in the given format.
+    """
+    buf = BytesIO()
+    Image.new("RGB", (4, 4), "red").save(buf, format=fmt)
+    return buf.getvalue()
+
+
+class _Response(object):
+    """
+    Minimal streamed response.
+    """
+
+    def __init__(self, status_code, content, content_type=""):
+        self.status_code = status_code
+        self.raw = BytesIO(content)
+        self.headers = {"Content-Type": content_type}
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _Transport(requests.adapters.HTTPAdapter):
+    """
+    Serve canned responses by url instead of opening connections.
+
+    A route is a (status, body[, headers]) tuple, or a function of the
+    request returning one. Unknown urls are answered with 404.
+    """
+
+    def __init__(self, routes=None):
+        super(_Transport, self).__init__()
+        self.routes = routes or {}
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request)
+        route = self.routes.get(request.url, (404, b""))
+        if callable(route):
+            route = route(request)
+        status, body, headers = (route + ({},))[:3]
+        if request.method == "HEAD":
+            body = b""
+        raw = HTTPResponse(
+            body=BytesIO(body),
+            headers=headers,
+            status=status,
+            preload_content=False,
+            request_method=request.method,
+            request_url=request.url,
+        )
+        return self.build_response(request, raw)
+
+
+def _session(routes=None):
+    """
+    A session served by a stub transport.
+    """
+    session = requests.Session()
+    session.mount("https://", _Transport(routes))
+    return session
+
+
+def _grabber(routes=None, url=START_URL, mode="crawl", **kwargs):
+    """
+    Build a grabber whose session is served by a stub transport.
+    """
+    connection = _Connection(_session(routes))
+    return ImageGrabber(url, "", mode, connection=connection, **kwargs)
+
+
+def _sent(grabber):
+    """
+    The method and url of every request sent after validating.
+    """
+    transport = grabber.session.get_adapter("https://")
+    return [(req.method, req.url) for req in transport.sent[1:]]
+
+
+def test_validate_reads_the_album_page(tmp_path):
+    """
+    Test the album details are parsed from a utf-8 page declaring no charset.
+    """
+    routes = {
+        START_URL: (200, INDEX_PAGE.encode("utf-8"), {"Content-Type": "text/html"}),
+        "https://www.example.org/photos-view-id-24.html": (200, VIEW_PAGE),
+    }
+    grabber = _grabber(routes)
+    assert grabber.valid
+    assert grabber.title == "標題"
+    assert grabber.page_num == 24
+    assert (grabber.tag, grabber.subtag) == ("doujin", "CN")
+    assert grabber.img_link == "/photos-view-id-1.html"
+    assert grabber.data_url == "//img/data/0024.jpg"
+    assert grabber.new_folder == "doujin/CN/標題"
+
+
+def test_validate_reads_nested_breadcrumb_text():
+    """
+    Test breadcrumb links wrapping their text in another element are read.
+    """
+    page = INDEX_PAGE.replace(">同人誌<", "><span>同人誌</span><").encode("utf-8")
+    routes = {
+        START_URL: (200, page),
+        "https://www.example.org/photos-view-id-24.html": (200, VIEW_PAGE),
+    }
+    grabber = _grabber(routes)
+    assert (grabber.tag, grabber.subtag) == ("doujin", "CN")
+
+
+def test_validate_accepts_a_short_breadcrumb():
+    """
+    Test a breadcrumb without category or language links gives unknown tags.
+    """
+    page = INDEX_PAGE.replace('<a href="/c">同人誌</a><a href="/l">漢化</a>', "")
+    routes = {
+        START_URL: (200, page.encode("utf-8")),
+        "https://www.example.org/photos-view-id-24.html": (200, VIEW_PAGE),
+    }
+    grabber = _grabber(routes)
+    assert grabber.valid
+    assert (grabber.tag, grabber.subtag) == ("unknown", "unknown")
+
+
+def test_validate_ignores_other_bread_classes():
+    """
+    Test only the bread class token marks the breadcrumb.
+    """
+    page = INDEX_PAGE.replace(
+        '<div class="png bread">',
+        '<div class="breadcrumbs"><a>x</a><a>單行本</a></div><div class="png bread">',
+    )
+    routes = {
+        START_URL: (200, page.encode("utf-8")),
+        "https://www.example.org/photos-view-id-24.html": (200, VIEW_PAGE),
+    }
+    assert _grabber(routes).tag == "doujin"
+
+
+def test_validate_refuses_a_page_without_page_count():
+    """
+    Test a page missing the page count label is not valid.
+    """
+    page = INDEX_PAGE.replace("頁數：24P", "").encode("utf-8")
+    routes = {
+        START_URL: (200, page),
+        "https://www.example.org/photos-view-id-24.html": (200, VIEW_PAGE),
+    }
+    assert not _grabber(routes).valid
+
+
+def test_page_cache_is_opt_in(monkeypatch):
+    """
+    Test the cached session is only used when asked for, and never for images.
+    """
+    opened = []
+
+    class CachedSession(requests.Session):
+        def __init__(self, cache_name, **kwargs):
+            super(CachedSession, self).__init__()
+            opened.append(kwargs)
+
+    stub = SimpleNamespace(CachedSession=CachedSession, DO_NOT_CACHE="never")
+    monkeypatch.setattr(image_grabber, "requests_cache", stub)
+    grabber = _grabber()
+    assert type(grabber._new_session()) is requests.Session and not opened
+    grabber.cache = True
+    assert isinstance(grabber._new_session(), CachedSession)
+    assert opened[0]["urls_expire_after"] == {
+        ImageGrabber.PAGE_URLS: ImageGrabber.PAGE_EXPIRE,
+        "*": "never",
+    }
+    monkeypatch.setattr(image_grabber, "requests_cache", None)
+    with pytest.raises(ImportError):
+        _grabber(cache=True)
+
+
+def test_save_image_keeps_matching_bytes():
+    """
+    Test images matching their extension are written untouched.
+    """
+    content = _image_bytes("PNG")
+    buf = BytesIO()
+    _grabber()._save_image(_Response(200, content), buf, "png")
+    assert buf.getvalue() == content
+
+
+def test_save_image_converts_mismatched_format():
+    """
+    Test images not matching their extension are converted by PIL.
+    """
+    buf = BytesIO()
+    _grabber()._save_image(_Response(200, _image_bytes("PNG")), buf, "jpg")
+    assert Image.open(buf).format == "JPEG"
+
+
+def test_save_image_trusts_content_type_without_signature():
+    """
+    Test images without a known signature are kept when the type matches.
+    """
+    content = _image_bytes("GIF")
+    buf = BytesIO()
+    _grabber()._save_image(_Response(200, content, "image/gif"), buf, "gif")
+    assert buf.getvalue() == content
+
+
+def test_check_images_verifies_without_reencoding():
+    """
+    Test checked images keep their bytes and broken ones are refused.
+    """
+    content = _image_bytes("JPEG")
+    buf = BytesIO()
+    _grabber(check_images=True)._save_image(_Response(200, content), buf, "jpg")
+    assert buf.getvalue() == content
+    with pytest.raises(OSError):
+        _grabber(check_images=True)._save_image(
+            _Response(200, content[:40]), BytesIO(), "jpg"
+        )
+
+
+def test_backoff_is_capped():
+    """
+    Test the jittered backoff never exceeds the cap.
+    """
+    for attempt in range(10):
+        assert 0 <= _backoff(attempt, 2, 60) <= min(60, 2 * 2 ** attempt)
+
+
+def test_retry_after_parsing():
+    """
+    Test Retry-After is read as seconds or as an http date.
+    """
+    assert _retry_after("7") == 7
+    assert _retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert _retry_after("soon") is None
+    assert _retry_after(None) is None
+
+
+def test_get_retries_with_retry_after(monkeypatch):
+    """
+    Test throttled responses are retried after the Retry-After delay.
+    """
+    responses = [(429, b"", {"Retry-After": "7"}), (200, b"")]
+    waits = []
+    monkeypatch.setattr(image_grabber.time, "sleep", waits.append)
+    # frozen clock, the limiter sees no time pass between the two requests
+    monkeypatch.setattr(image_grabber.time, "monotonic", lambda: 100.0)
+    grabber = _grabber({"https://example.org/": lambda req: responses.pop(0)})
+    assert grabber._get("https://example.org/").status_code == 200
+    # the throttled limiter then holds the retry back for one token
+    assert waits == [7, 1 / _RateLimiter.START_RATE]
+
+
+def test_get_gives_up_on_long_retry_after(monkeypatch):
+    """
+    Test a Retry-After beyond the longest wait is not waited for.
+    """
+    waits = []
+    monkeypatch.setattr(image_grabber.time, "sleep", waits.append)
+    grabber = _grabber({"https://example.org/": (429, b"", {"Retry-After": "3600"})})
+    with pytest.raises(requests.HTTPError, match="asks to wait 3600 s"):
+        grabber._get("https://example.org/")
+    assert not waits and len(_sent(grabber)) == 1
+
+
+def test_throttled_image_is_reported(monkeypatch, tmp_path, capsys):
+    """
+    Test an image given up on while throttled is reported, not silently skipped.
+    """
+    monkeypatch.setattr(image_grabber.time, "sleep", lambda wait: None)
+    grabber = _grabber(
+        {
+            "https://img/0.jpg": (200, _image_bytes("JPEG")),
+            "https://img/1.jpg": (503, b""),
+        },
+        zip_only=True,
+    )
+    grabber.title = "album"
+    grabber.new_folder = str(tmp_path)
+    urls = [("//img/%i.jpg" % i, "https://page") for i in range(2)]
+    grabber._download_list(urls, len(urls))
+    out = capsys.readouterr().out
+    assert "An image cannot be downloaded: 503 for https://img/1.jpg" in out
+    with zipfile.ZipFile(str(tmp_path / "album.cbz")) as zipf:
+        assert zipf.namelist() == ["0.jpg"]
+
+
+def test_errors_throttle_then_refresh_session(monkeypatch):
+    """
+    Test repeated refusals first slow down requests, then renew the session.
+    """
+    waits = []
+    monkeypatch.setattr(image_grabber.time, "sleep", waits.append)
+    closed = []
+    grabber = _grabber()
+    session = grabber.session
+    session.close = lambda: closed.append(session)
+    grabber._new_session = lambda: "new session"
+    errors = grabber.connection.errors["host"]
+    errors.extend([image_grabber.time.monotonic()] * 5)
+    grabber._throttle("host")
+    assert len(waits) == 1 and grabber.session is session
+    errors.extend([image_grabber.time.monotonic()] * 5)
+    grabber._throttle("host")
+    assert grabber.session == "new session" and not errors
+    assert closed == [session]
+
+
+def test_download_image_falls_back_to_other_extension():
+    """
+    Test a missing jpg is probed as png, which generated urls then try first.
+    """
+    content = _image_bytes("PNG")
+    grabber = _grabber(
+        {"https://img/0.png": (200, content), "https://img/1.png": (200, content)},
+        mode="normal",
+        zip_only=True,
+    )
+    grabber.new_folder = ""
+    img = grabber._download_image(0, "//img/0.jpg", "https://page")
+    assert img == ("0.png", content)
+    img = grabber._download_image(1, "//img/1.jpg", "https://page")
+    assert img == ("1.png", content)
+    assert _sent(grabber) == [
+        ("GET", "https://img/0.jpg"),
+        ("HEAD", "https://img/0.png"),
+        ("GET", "https://img/0.png"),
+        ("GET", "https://img/1.png"),
+    ]
+    transport = grabber.session.get_adapter("https://")
+    assert all(req.headers["Referer"] == "https://page" for req in transport.sent[1:])
+
+
+def test_crawled_urls_keep_their_own_extension():
+    """
+    Test a png page of a jpg album does not make crawled urls start with png.
+    """
+    jpg, png = _image_bytes("JPEG"), _image_bytes("PNG")
+    grabber = _grabber(
+        {"https://img/0.png": (200, png), "https://img/1.jpg": (200, jpg)},
+        zip_only=True,
+    )
+    grabber.new_folder = ""
+    assert grabber._download_image(0, "//img/0.png", "https://page")[0] == "0.png"
+    assert grabber._download_image(1, "//img/1.jpg", "https://page")[0] == "1.jpg"
+    assert _sent(grabber) == [
+        ("GET", "https://img/0.png"),
+        ("GET", "https://img/1.jpg"),
+    ]
+
+
+def test_resumed_download_sends_conditional_get(tmp_path):
+    """
+    Test an image saved by an earlier run is reused when not modified.
+    """
+    content = _image_bytes("JPEG")
+
+    def image(request):
+        if "If-None-Match" in request.headers:
+            return 304, b""
+        return 200, content, {"ETag": '"v1"'}
+
+    grabber = _grabber({"https://img/0.jpg": image})
+    grabber.new_folder = str(tmp_path)
+    assert grabber._download_image(0, "//img/0.jpg", "https://page")[0] == "0.jpg"
+    grabber._save_manifest()
+    grabber._manifest = {}
+    grabber._load_manifest()
+    assert grabber._download_image(0, "//img/0.jpg", "https://page") == (
+        "0.jpg",
+        content,
+    )
+    request = grabber.session.get_adapter("https://").sent[-1]
+    assert request.headers["If-None-Match"] == '"v1"'
+
+
+def test_load_manifest_drops_bad_entries(tmp_path):
+    """
+    Test a manifest not written by the grabber does not break the download.
+    """
+    grabber = _grabber()
+    grabber.new_folder = str(tmp_path)
+    path = tmp_path / ImageGrabber.MANIFEST
+    path.write_text("[1, 2]")
+    grabber._load_manifest()
+    assert grabber._manifest == {}
+    good = {"name": "0.jpg", "etag": '"v1"', "last_modified": None}
+    path.write_text(
+        json.dumps(
+            {
+                "a": good,
+                "b": "0.jpg",
+                "c": {"etag": '"v1"'},
+                "d": {"name": "../0.jpg", "etag": '"v1"'},
+                "e": {"name": "0.jpg", "etag": 1},
+            }
+        )
+    )
+    grabber._load_manifest()
+    assert grabber._manifest == {"a": good}
+
+
+def test_probe_falls_back_to_range_request():
+    """
+    Test a refused HEAD probe is retried as a one byte ranged GET.
+    """
+    ranges = []
+
+    def image(request):
+        if request.method == "HEAD":
+            return 405, b""
+        ranges.append(request.headers["Range"])
+        return 206, b"x"
+
+    grabber = _grabber({"https://img/0.png": image})
+    assert grabber._probe("https://img/0.png", {"Referer": "https://page"}) == 200
+    assert ranges == ["bytes=0-0"]
+
+
+def test_probe_is_retried_and_follows_redirects(monkeypatch):
+    """
+    Test a throttled probe is retried and a redirected one followed.
+    """
+    responses = [(429, b"", {"Retry-After": "1"}), (302, b"", {"Location": "/1.png"})]
+    monkeypatch.setattr(image_grabber.time, "sleep", lambda wait: None)
+    grabber = _grabber(
+        {
+            "https://img/0.png": lambda req: responses.pop(0),
+            "https://img/1.png": (200, b""),
+        }
+    )
+    assert grabber._probe("https://img/0.png") == 200
+    assert _sent(grabber) == [
+        ("HEAD", "https://img/0.png"),
+        ("HEAD", "https://img/0.png"),
+        ("HEAD", "https://img/1.png"),
+    ]
+
+
+def test_download_list_keeps_the_order(tmp_path):
+    """
+    Test the images are archived in order, whichever finishes first.
+    """
+    content = _image_bytes("JPEG")
+
+    def image(delay):
+        def route(request):
+            time.sleep(delay)
+            return 200, content
+
+        return route
+
+    routes = {"https://img/%i.jpg" % i: image(0.1 * (2 - i)) for i in range(3)}
+    routes["https://img/1.jpg"] = (404, b"")
+    grabber = _grabber(routes, zip_only=True)
+    grabber.title = "album"
+    grabber.new_folder = str(tmp_path)
+    urls = [("//img/%i.jpg" % i, "https://page") for i in range(3)]
+    grabber._download_list(urls, len(urls))
+    with zipfile.ZipFile(str(tmp_path / "album.cbz")) as zipf:
+        assert zipf.namelist() == ["0.jpg", "2.jpg"]
+
+
+def test_download_list_stops_the_producer_on_error(tmp_path):
+    """
+    Test an archiving error stops the url producer instead of leaving it blocked.
+    """
+    closed = []
+
+    def urls():
+        try:
+            for i in range(10 * ImageGrabber.QUEUE_SIZE):
+                yield "//img/%i.jpg" % i, "https://page"
+        finally:
+            closed.append(True)
+
+    def download_image(index, url, referer):
+        raise ValueError(url)
+
+    grabber = _grabber(zip_only=True)
+    grabber.title = "album"
+    grabber.new_folder = str(tmp_path)
+    grabber._download_image = download_image
+    with pytest.raises(ValueError):
+        grabber._download_list(urls(), 10 * ImageGrabber.QUEUE_SIZE)
+    assert closed == [True]
+
+
+def test_batch_download_shares_the_connection(monkeypatch, tmp_path):
+    """
+    Test the albums of a batch share one connection, closed at the end.
+    """
+    urls = ["https://www.example.org/photos-index-aid-%i.html" % aid for aid in (1, 2)]
+    routes = {
+        url: (200, INDEX_PAGE.replace("標題", "album %i" % aid).encode("utf-8"))
+        for aid, url in enumerate(urls, 1)
+    }
+    routes["https://www.example.org/photos-view-id-24.html"] = (200, VIEW_PAGE)
+    session = _session(routes)
+    closed = []
+    session.close = lambda: closed.append(True)
+    monkeypatch.setattr(ImageGrabber, "_new_session", lambda self: session)
+    grabbers = batch_download(urls, str(tmp_path), "normal", zip_only=True)
+    assert [grabber.valid for grabber in grabbers] == [True, True]
+    assert grabbers[0].connection is grabbers[1].connection
+    for aid in (1, 2):
+        assert (tmp_path / "doujin/CN/album {0}/album {0}.cbz".format(aid)).exists()
+    assert closed == [True]
+
+
+def test_batch_download_reports_errors_per_url(monkeypatch, tmp_path, capsys):
+    """
+    Test an error with one url neither stops nor hides the other albums.
+    """
+
+    def refused(request):
+        raise requests.ConnectionError("refused")
+
+    urls = [
+        "https://www.example.org/photos-index-aid-%i.html" % aid for aid in (1, 2, 3)
+    ]
+    routes = {
+        url: (200, INDEX_PAGE.replace("標題", "album %i" % aid).encode("utf-8"))
+        for aid, url in enumerate(urls, 1)
+    }
+    routes[urls[0]] = refused
+    routes["https://www.example.org/photos-view-id-24.html"] = (200, VIEW_PAGE)
+    session = _session(routes)
+    monkeypatch.setattr(ImageGrabber, "_new_session", lambda self: session)
+    download = ImageGrabber.download
+
+    def failing_download(self):
+        if self.title == "album 2":
+            raise ValueError("broken album")
+        download(self)
+
+    monkeypatch.setattr(ImageGrabber, "download", failing_download)
+    grabbers = batch_download(urls, str(tmp_path), "normal", zip_only=True)
+    assert [grabber.url for grabber in grabbers] == urls[1:]
+    assert (tmp_path / "doujin/CN/album 3/album 3.cbz").exists()
+    out = capsys.readouterr().out
+    assert urls[0] + " cannot be opened: refused" in out
+    assert urls[1] + " cannot be downloaded: broken album" in out
+
+
+def test_rate_limiter_only_limits_once_throttled():
+    """
+    Test the rate starts unlimited, halves when throttled and recovers.
+    """
+    limiter = _RateLimiter()
+    limiter.succeeded()
+    assert limiter.rate is None
+    limiter.throttled()
+    limiter.throttled()
+    assert limiter.rate == _RateLimiter.START_RATE / 2
+    for _i in range(_RateLimiter.RAISE_AFTER):
+        limiter.succeeded()
+    assert limiter.rate == _RateLimiter.START_RATE / 2 * 1.1
+    limiter.rate = _RateLimiter.MAX_RATE
+    for _i in range(_RateLimiter.RAISE_AFTER):
+        limiter.succeeded()
+    assert limiter.rate is None
+
+
+def test_refusals_do_not_raise_the_rate(monkeypatch):
+    """
+    Test only served requests count toward raising the rate.
+    """
+    monkeypatch.setattr(image_grabber.time, "sleep", lambda wait: None)
+    grabber = _grabber(
+        {"https://img/ok.jpg": (200, b""), "https://img/no.jpg": (403, b"")}
+    )
+    limiter = grabber.connection.limiters["img"]
+    limiter.throttled()
+    for _i in range(_RateLimiter.RAISE_AFTER - 1):
+        grabber._get("https://img/ok.jpg").close()
+    grabber._get("https://img/no.jpg").close()
+    grabber._get("https://img/ok.jpg").close()
+    assert limiter.rate == _RateLimiter.START_RATE
+    for _i in range(_RateLimiter.RAISE_AFTER - 1):
+        grabber._get("https://img/ok.jpg").close()
+    assert limiter.rate == _RateLimiter.START_RATE * 1.1
@@ -50,3 +50,42 @@ def test_special_urls():
         "img2.wxxx.download/data/1017/49/000000000000005.jpg",
         "img2.wxxx.download/data/1017/49/000000000000006.jpg",
     ]
+
+
+def test_each_number_of_the_file_name_is_a_variable():
+    """
+    Test equal numbers of the file name are numbered separately.
+    """
+    url_generator = URLProcessor("img2.wxxx.download/data/1017/49/01_01.jpg", 1)
+    assert list(url_generator.normal_url_list()) == [
+        "img2.wxxx.download/data/1017/49/00_00.jpg",
+        "img2.wxxx.download/data/1017/49/01_01.jpg",
+    ]
+    special = list(url_generator.special_url_list())
+    assert special[0] == "img2.wxxx.download/data/1017/49/00_00a.jpg"
+
+
+def test_folders_are_left_unchanged():
+    """
+    Test numbers in the folders are kept even when they repeat the file name.
+    """
+    url_generator = URLProcessor("img2.wxxx.download/data/001/001.jpg", 1)
+    assert list(url_generator.normal_url_list()) == [
+        "img2.wxxx.download/data/001/000.jpg",
+        "img2.wxxx.download/data/001/001.jpg",
+    ]
+    assert list(url_generator.special_url_list(sep="-"))[0] == (
+        "img2.wxxx.download/data/001/000-a.jpg"
+    )
+
+
+def test_file_name_without_number():
+    """
+    Test a file name without number gives no special url.
+    """
+    url_generator = URLProcessor("img2.wxxx.download/data/1017/49/cover.jpg", 1)
+    assert list(url_generator.normal_url_list()) == [
+        "img2.wxxx.download/data/1017/49/cover.jpg",
+        "img2.wxxx.download/data/1017/49/cover.jpg",
+    ]
+    assert list(url_generator.special_url_list()) == []
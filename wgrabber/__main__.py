@@ -4,26 +4,57 @@ from os.path import expanduser
 import click
 
 from . import __version__
-from .image_grabber import ImageGrabber
+from .image_grabber import ImageGrabber, batch_download, requests_cache
 
 
 @click.command()
-@click.argument("url")
+@click.argument("urls", nargs=-1, required=True)
 @click.option("--folder", default="~/Hmanga/", help="The folder to save manga.")
 @click.option("--mode", default="crawl", help="The mode for downloading")
+@click.option(
+    "--check-images", is_flag=True, help="Verify every image before saving it."
+)
+@click.option("--zip-only", is_flag=True, help="Only save the images in the cbz file.")
+@click.option(
+    "--workers",
+    default=ImageGrabber.DOWNLOAD_WORKERS,
+    type=click.IntRange(min=1),
+    help="The number of images downloaded at the same time.",
+)
+@click.option(
+    "--cache",
+    is_flag=True,
+    help="Keep the pages between runs, needs the requests-cache package.",
+)
+@click.option(
+    "--jobs",
+    default=1,
+    type=click.IntRange(min=1),
+    help="The number of albums downloaded at the same time.",
+)
 @click.version_option(version=__version__, message="Wgrabber %(version)s")
-def main(url, folder, mode):
+def main(urls, folder, mode, check_images, zip_only, workers, cache, jobs):
     """
     Command line tool to download the manga from the website Wxxx.
     """
+    if cache and requests_cache is None:
+        raise click.UsageError("--cache needs the requests-cache package.")
     path = expanduser(folder)
     if not path.endswith(os.path.sep):
         path += os.path.sep
-    manga = ImageGrabber(url, path, mode)
-    if manga.valid:
-        manga.download()
-    else:
-        click.echo("The start url is not recognized.")
+    mangas = batch_download(
+        urls,
+        path,
+        mode,
+        jobs,
+        check_images=check_images,
+        zip_only=zip_only,
+        workers=workers,
+        cache=cache,
+    )
+    for manga in mangas:
+        if not manga.valid:
+            click.echo(f"The start url is not recognized: {manga.url}")
 
 
 if __name__ == "__main__":
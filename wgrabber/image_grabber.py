@@ -1,39 +1,488 @@
+import codecs
+import json
+import mimetypes
 import os
+import queue
+import random
 import re
+import shutil
+import threading
+import time
 import zipfile
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.message import Message
+from email.utils import parsedate_to_datetime
 from io import BytesIO
+from itertools import chain
+from types import MappingProxyType
+from urllib.parse import urlparse
 
 import click
 import requests
-from bs4 import BeautifulSoup
+from lxml import etree
+from lxml import html as lxml_html
 from PIL import Image
+from urllib3.util import make_headers
 
 from .url_processor import URLProcessor
 
+try:
+    import requests_cache
+except ImportError:  # optional, only needed to cache the pages
+    requests_cache = None
+
+# leading bytes of the image formats the site serves, keyed by file extension
+IMAGE_SIGNATURES = {
+    "jpg": b"\xff\xd8\xff",
+    "jpeg": b"\xff\xd8\xff",
+    "png": b"\x89PNG\r\n\x1a\n",
+}
+
+# compiled once, shared by every page of every album
+_XPATH_PICAREA = etree.XPath('//img[@id="picarea"]/@src')
+_XPATH_IMGAREA = etree.XPath('//span[@id="imgarea"]//a//img/@src')
+_XPATH_NEXT_PAGE = etree.XPath('//div[contains(@class, "newpage")]//a/@href')
+_XPATH_PAGES_LABEL = etree.XPath('string(//label[contains(., "頁數")])')
+_XPATH_TITLE = etree.XPath("string((//h2)[1])")
+_XPATH_FIRST_LINK = etree.XPath('(//div[contains(@class, "pic_box")])[1]//a/@href')
+_XPATH_LAST_LINK = etree.XPath('(//div[contains(@class, "pic_box")])[last()]//a/@href')
+_XPATH_BREAD_LINKS = etree.XPath(
+    '//div[contains(concat(" ", normalize-space(@class), " "), " bread ")]//a'
+)
+
+
+# a charset declared by a meta tag near the top of the page
+_META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset=["']?([\w-]+)""", re.IGNORECASE)
+
+
+def _parse(r):
+    """
+    Parse the html page of the response into an lxml document.
+
+    The charset of the Content-Type header wins, then the one of a meta tag,
+    and pages declaring none are read as utf-8 rather than latin-1.
+    """
+    message = Message()
+    message["Content-Type"] = r.headers.get("Content-Type", "")
+    encoding = message.get_content_charset()
+    if not encoding:
+        match = _META_CHARSET_RE.search(r.content[:4096])
+        encoding = match.group(1).decode("ascii") if match else "utf-8"
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        encoding = "utf-8"
+    # the pages are always full documents, skip the fragment detection
+    return lxml_html.document_fromstring(
+        r.content, parser=lxml_html.HTMLParser(encoding=encoding)
+    )
+
+
+def _backoff(attempt, base, cap):
+    """
+    Full jitter exponential backoff wait for the retry attempt.
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def _retry_after(value):
+    """
+    Seconds to wait from a Retry-After header, None when it is not usable.
+
+    The header holds either a number of seconds or an http date.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when is None:
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def _put_unless_stopped(items, item, stop):
+    """
+    Put the item in the bounded queue, tell whether stop was set first.
+    """
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+class _RateLimiter(object):
+    """
+    Token bucket for the requests to one host, only limiting once throttled.
+
+    A throttled response halves the rate, starting from START_RATE, and every
+    run of RAISE_AFTER successful ones raises it by 10% until the limit is
+    lifted again above MAX_RATE. Any other answer of the host, a refusal or
+    a missing page, starts that run over.
+    """
+
+    START_RATE = 8.0
+    MIN_RATE = 0.5
+    MAX_RATE = 64.0
+    RAISE_AFTER = 20
+
+    def __init__(self, capacity=4):
+        """
+        The constructor func, requests are not limited to start with.
+        """
+        self.capacity = capacity
+        self.rate = None
+        self._tokens = 0.0
+        self._stamp = time.monotonic()
+        self._successes = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until a request may be sent.
+        """
+        with self._lock:
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._stamp) * self.rate
+            )
+            self._stamp = now
+            # taking the token before sleeping keeps the place in the line
+            self._tokens -= 1
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttled(self):
+        """
+        The host pushed back, halve the rate.
+        """
+        with self._lock:
+            if self.rate is None:
+                self.rate = self.START_RATE
+                self._tokens = 0.0
+                self._stamp = time.monotonic()
+            else:
+                self.rate = max(self.MIN_RATE, self.rate / 2)
+            self._successes = 0
+
+    def succeeded(self):
+        """
+        The host served the request, raise the rate after enough successes.
+        """
+        with self._lock:
+            if self.rate is None:
+                return
+            self._successes += 1
+            if self._successes >= self.RAISE_AFTER:
+                self._successes = 0
+                self.rate *= 1.1
+                if self.rate > self.MAX_RATE:
+                    self.rate = None
+
+    def failed(self):
+        """
+        The host answered without serving the request, count the successes
+        from zero again, the rate itself is kept.
+        """
+        with self._lock:
+            self._successes = 0
+
+
+class _Connection(object):
+    """
+    The session and the pacing of the requests to each host.
+
+    The grabbers of a batch share one, so that the host sees a single
+    adaptive rate and a single window of refusals whatever the number of
+    albums downloaded at the same time.
+    """
+
+    def __init__(self, session):
+        """
+        The constructor func.
+        """
+        self.session = session
+        self.errors = defaultdict(deque)
+        self.limiters = defaultdict(_RateLimiter)
+        self.lock = threading.Lock()
+
 
 class ImageGrabber(object):
     """
     the image grabber class.
     """
 
-    def __init__(self, start_url, base_path, mode):
+    # default number of images downloaded at the same time
+    DOWNLOAD_WORKERS = 8
+    # downloads submitted ahead of the ones being archived
+    QUEUE_SIZE = 16
+    # status codes worth retrying and how often to retry them
+    RETRY_STATUS = (429, 503)
+    MAX_RETRIES = 3
+    # longest wait before a retry, a url asking for longer is given up
+    MAX_RETRY_WAIT = 60
+    # refusals counted per host over the last ERROR_WINDOW seconds, enough of
+    # them slow the requests down and even more start a new session
+    ERROR_STATUS = (403, 429, 503)
+    ERROR_WINDOW = 60
+    THROTTLE_ERRORS = 5
+    REFRESH_ERRORS = 10
+    # kept in the album folder, the validators of every saved image so that a
+    # resumed run only downloads the images again when they changed
+    MANIFEST = ".wgrabber_cache.json"
+    # the other extension to look for when an image is not found
+    ALTERNATE_EXT = {"jpg": "png", "png": "jpg"}
+    # connections kept alive to the host, raised to the number of workers
+    POOL_SIZE = 32
+    # seconds to wait on a connection, a stale keep-alive socket must not hang
+    TIMEOUT = 30
+    # each new session picks one, so refreshed sessions look like another browser
+    USER_AGENTS = (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) "
+        "Gecko/20100101 Firefox/121.0",
+        "Mozilla/5.0 (X11; Linux x86_64; rv:121.0) Gecko/20100101 Firefox/121.0",
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 "
+        "(KHTML, like Gecko) Version/17.2 Safari/605.1.15",
+    )
+    # with the cache, album and image pages are kept by requests-cache for an
+    # hour, the images themselves and everything else are never cached
+    PAGE_CACHE = "wgrabber_http_cache"
+    PAGE_URLS = "*/photos-*"
+    PAGE_EXPIRE = 3600
+    # read-only, the session copies them once when it is created
+    HEADERS = MappingProxyType(
+        {
+            "Accept-Language": "zh-TW,zh;q=0.9,en;q=0.8",
+            # only advertise the encodings urllib3 can decode, br needs brotli
+            "Accept-Encoding": make_headers(accept_encoding=True)["accept-encoding"],
+        }
+    )
+    # folder names for the category and language breadcrumb tags
+    CATEGORY_MAPPING = {"單行本": "volume", "雜誌&短篇": "short", "同人誌": "doujin"}
+    LANGUAGE_MAPPING = {"漢化": "CN", "日語": "JP", "CG畫集": "CG", "Cosplay": "COS"}
+    _DIGIT_RE = re.compile(r"\d+")
+
+    def __init__(
+        self,
+        start_url,
+        base_path,
+        mode,
+        check_images=False,
+        zip_only=False,
+        workers=DOWNLOAD_WORKERS,
+        cache=False,
+        connection=None,
+    ):
         """
-        The constructor func.
+        The constructor func, the connection may be shared with other grabbers.
         """
         self.url = start_url
         self.base_path = base_path
         self.base_url = "https://" + (self.url.split("/"))[-2]
         self.mode = mode
-        self.validate()
+        # verify every image with PIL instead of trusting the leading bytes
+        self.check_images = check_images
+        # only keep the images inside the cbz file
+        self.zip_only = zip_only
+        self.workers = workers
+        # keep the pages in the requests-cache sqlite cache between runs
+        self.cache = cache
+        if cache and requests_cache is None:
+            raise ImportError("The page cache needs the requests-cache package.")
+        self._preferred_ext = None
+        own_connection = connection is None
+        if own_connection:
+            connection = _Connection(self._new_session())
+        self.connection = connection
+        self._manifest = {}
+        self._manifest_lock = threading.Lock()
+        try:
+            self.validate()
+        except BaseException:
+            # nobody else gets to close a session opened for this grabber
+            if own_connection:
+                self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def session(self):
+        """
+        The current session of the connection, renewed after many refusals.
+        """
+        return self.connection.session
+
+    def close(self):
+        """
+        Close the connections kept alive by the session.
+        """
+        self.session.close()
+
+    def _new_session(self):
+        """
+        Create the http session shared by all requests.
+        """
+        # one session for every request so the connection to the host is kept alive
+        if self.cache:
+            # a resumed or repeated run reads the pages it saw from the cache,
+            # expired ones are revalidated with their ETag or Last-Modified
+            # like the images of the manifest
+            session = requests_cache.CachedSession(
+                self.PAGE_CACHE,
+                backend="sqlite",
+                use_cache_dir=True,
+                urls_expire_after={
+                    self.PAGE_URLS: self.PAGE_EXPIRE,
+                    "*": requests_cache.DO_NOT_CACHE,
+                },
+                allowable_methods=("GET",),
+            )
+        else:
+            session = requests.Session()
+        pool_size = max(self.POOL_SIZE, self.workers)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update(self.HEADERS)
+        session.headers["User-Agent"] = random.choice(self.USER_AGENTS)
+        return session
+
+    def _throttle(self, host):
+        """
+        Slow down, or start a new session, when the host keeps refusing requests.
+        """
+        connection = self.connection
+        old = None
+        with connection.lock:
+            errors = connection.errors[host]
+            while errors and errors[0] < time.monotonic() - self.ERROR_WINDOW:
+                errors.popleft()
+            count = len(errors)
+            if count >= self.REFRESH_ERRORS:
+                errors.clear()
+                old, connection.session = connection.session, self._new_session()
+        if old is not None:
+            # requests still running on it are completed, its idle sockets closed
+            old.close()
+        if count >= self.THROTTLE_ERRORS:
+            time.sleep(random.uniform(5, 15))
+
+    def _send(self, req, settings, host):
+        """
+        Send the prepared request at the pace the host currently accepts,
+        keeping track of its refusals.
+        """
+        self._throttle(host)
+        with self.connection.lock:
+            limiter = self.connection.limiters[host]
+        limiter.acquire()
+        r = self.session.send(req, **settings)
+        if r.status_code in self.ERROR_STATUS:
+            with self.connection.lock:
+                self.connection.errors[host].append(time.monotonic())
+        if r.status_code in self.RETRY_STATUS:
+            limiter.throttled()
+        elif 200 <= r.status_code < 300 or r.status_code == 304:
+            limiter.succeeded()
+        else:
+            limiter.failed()
+        return r
+
+    def _get(self, url, stream=False, headers=None):
+        """
+        Get the url, backing off and retrying when the server is throttling.
+        """
+        return self._request("GET", url, stream, headers)
+
+    def _request(self, method, url, stream=False, headers=None):
+        """
+        Send the request, backing off and retrying when the server is throttling.
+
+        Redirects are followed whatever the method. An HTTPError is raised when
+        the server keeps throttling, or asks to wait longer than MAX_RETRY_WAIT.
+        """
+        # prepare once, the retries resend the very same request
+        req = self.session.prepare_request(
+            requests.Request(method, url, headers=headers)
+        )
+        settings = self.session.merge_environment_settings(
+            req.url, {}, stream, None, None
+        )
+        settings["timeout"] = self.TIMEOUT
+        host = urlparse(url).netloc
+        r = self._send(req, settings, host)
+        for attempt in range(self.MAX_RETRIES):
+            if r.status_code not in self.RETRY_STATUS:
+                return r
+            wait = _retry_after(r.headers.get("Retry-After"))
+            if wait is None:
+                wait = _backoff(attempt, 2, self.MAX_RETRY_WAIT)
+            elif wait > self.MAX_RETRY_WAIT:
+                break
+            r.close()
+            time.sleep(wait)
+            r = self._send(req, settings, host)
+        if r.status_code not in self.RETRY_STATUS:
+            return r
+        r.close()
+        # given up, raised so that the skipped url is reported by the caller
+        wait = _retry_after(r.headers.get("Retry-After"))
+        if wait is not None and wait > self.MAX_RETRY_WAIT:
+            reason = f"the server asks to wait {wait:.0f} s"
+        else:
+            reason = f"still throttled after {self.MAX_RETRIES} retries"
+        raise requests.HTTPError(
+            f"{r.status_code} for {url}, {reason}, giving up", response=r
+        )
+
+    def _probe(self, url, headers=None):
+        """
+        Check whether the url exists without downloading it.
+
+        Servers refusing HEAD are asked for the first byte only instead.
+        """
+        # paced and retried like the downloads themselves
+        with self._request("HEAD", url, headers=headers) as r:
+            if r.status_code not in (405, 501):
+                return r.status_code
+        headers = dict(headers or {}, Range="bytes=0-0")
+        with self._get(url, stream=True, headers=headers) as r:
+            return 200 if r.status_code == 206 else r.status_code
 
     def _url_resolver(self, next_url):
         """
         Get the data url from passed url.
         """
         url = self.base_url + next_url
-        r = requests.get(url)
-        soup = BeautifulSoup(r.content, "lxml")
-        src = soup.find("img", {"id": "picarea"})["src"]
+        r = self._get(url)
+        doc = _parse(r)
+        src = _XPATH_PICAREA(doc)[0]
         return src
 
     def validate(self):
@@ -41,46 +490,40 @@ class ImageGrabber(object):
         Validate the url and content.
         """
         if self.url:
-            self.result = requests.get(self.url)
+            self.result = self._get(self.url)
             if self.result.status_code == 200:
-                soup = BeautifulSoup(self.result.content, "lxml")
-                try:
-                    self.title = soup.find_all("h2")[0].string.strip()
-                except IndexError:
+                doc = _parse(self.result)
+                # each lookup returns the strings directly, no element lists
+                self.title = _XPATH_TITLE(doc).strip()
+                if not self.title:
                     print("Please make sure the url is correct.")
                     self.valid = False
                     return
-                link = soup.find_all("div", {"class": "pic_box"})[-1].find("a")
+                link = _XPATH_LAST_LINK(doc)
                 # also save the first link
-                self.img_link = soup.find("div", {"class": "pic_box"}).find("a")["href"]
+                self.img_link = _XPATH_FIRST_LINK(doc)[0]
                 if link:
-                    self.data_url = self._url_resolver(link["href"])
-                    patten = re.compile(r"頁數")
-                    pages = re.findall(r"\d+", soup.find("label", text=patten).string)
-                    self.page_num = int(pages[0])
+                    self.data_url = self._url_resolver(link[0])
+                    pages = self._DIGIT_RE.search(_XPATH_PAGES_LABEL(doc))
+                    if not pages:
+                        print("Cannot find the number of pages.")
+                        self.valid = False
+                        return
+                    self.page_num = int(pages.group(0))
                     # find the catagory and lang tags
-                    tags = soup.find("div", {"class": "png bread"}).find_all("a")
-                    if tags[1].string == "單行本":
-                        self.tag = "volume"
-                    elif tags[1].string == "雜誌&短篇":
-                        self.tag = "short"
-                    elif tags[1].string == "同人誌":
-                        self.tag = "doujin"
+                    # one entry per link, empty links must keep their position
+                    tags = [a.text_content() for a in _XPATH_BREAD_LINKS(doc)]
+                    if len(tags) > 1:
+                        self.tag = self.CATEGORY_MAPPING.get(tags[1], "unknown")
                     else:
                         self.tag = "unknown"
-                    try:
-                        if tags[2].string == "漢化":
-                            self.subtag = "CN"
-                        elif tags[2].string == "日語":
-                            self.subtag = "JP"
-                        elif tags[2].string == "CG畫集":
-                            self.subtag = "CG"
-                        elif tags[2].string == "Cosplay":
-                            self.subtag = "COS"
-                        else:
-                            self.subtag = "unknown"
-                    except IndexError:
+                    if len(tags) > 2:
+                        self.subtag = self.LANGUAGE_MAPPING.get(tags[2], "unknown")
+                    else:
                         self.subtag = "unknown"
+                    self.new_folder = os.path.join(
+                        self._base_path_modifier(), self.title
+                    )
                     self.valid = True
                 else:
                     print("Cannot find data url.")
@@ -96,72 +539,331 @@ class ImageGrabber(object):
         """
         Generate the new path based on the tags.
         """
-        return self.base_path + self.tag + "/" + self.subtag + "/"
+        return os.path.join(self.base_path, self.tag, self.subtag)
+
+    def _save_image(self, r, f, ext):
+        """
+        Write the image of the streamed response into the empty buffer f.
+
+        The stream is copied as it is when it already matches the format
+        of the file extension, otherwise PIL converts it. The format is told
+        by the leading bytes, or by the Content-Type for extensions without
+        a known signature.
+        """
+        r.raw.decode_content = True
+        head = r.raw.read(16)
+        signature = IMAGE_SIGNATURES.get(ext.lower())
+        if signature:
+            matches = head.startswith(signature)
+        else:
+            content_type = r.headers.get("Content-Type", "").split(";")[0].strip()
+            matches = content_type == mimetypes.guess_type("image." + ext)[0]
+        if matches:
+            f.write(head)
+            shutil.copyfileobj(r.raw, f, length=64 * 1024)
+            if self.check_images:
+                # only verify, in place, re-encoding would lose jpeg quality
+                f.seek(0)
+                try:
+                    Image.open(f).verify()
+                except SyntaxError as err:
+                    raise OSError(err) from err
+                f.seek(0, os.SEEK_END)
+            return
+        # PIL needs the whole image, stream it into a single buffer
+        data = BytesIO()
+        data.write(head)
+        shutil.copyfileobj(r.raw, data, length=64 * 1024)
+        data.seek(0)
+        img = Image.open(data)
+        img.save(f, format=Image.registered_extensions()["." + ext.lower()])
+
+    def _load_manifest(self):
+        """
+        Read the manifest left in the new folder by an earlier run.
+
+        Entries not shaped like the ones written by _download_image are dropped.
+        """
+        self._manifest = {}
+        try:
+            path = os.path.join(self.new_folder, self.MANIFEST)
+            with open(path, encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(manifest, dict):
+            return
+        for url, entry in manifest.items():
+            if not isinstance(entry, dict):
+                continue
+            name = entry.get("name")
+            # only a file of the new folder itself
+            if not isinstance(name, str) or not name or os.path.basename(name) != name:
+                continue
+            if not all(
+                isinstance(entry.get(key), (str, type(None)))
+                for key in ("etag", "last_modified")
+            ):
+                continue
+            self._manifest[url] = entry
+
+    def _save_manifest(self):
+        """
+        Write the manifest into the new folder, replacing the previous one.
+
+        A manifest that cannot be written is reported, never raised, it must
+        not hide the error that interrupted the download.
+        """
+        path = os.path.join(self.new_folder, self.MANIFEST)
+        with self._manifest_lock:
+            data = json.dumps(self._manifest, ensure_ascii=False)
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+        except OSError as err:
+            print(f"The download manifest cannot be saved: {err}")
+
+    def _cached(self, url):
+        """
+        The name of the image saved for the url and the headers asking whether
+        it changed since, None when there is no usable saved image.
+        """
+        if self.zip_only:
+            return None
+        with self._manifest_lock:
+            entry = self._manifest.get(url)
+        if not entry:
+            return None
+        if not os.path.exists(os.path.join(self.new_folder, entry["name"])):
+            return None
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        if not headers:
+            return None
+        return entry["name"], headers
 
     def _page_crawl(self, start):
         """
-        The page crawler iterator.
+        The page crawler iterator, yield each image url with its page url.
         """
         url = self.base_url + start
         for _i in range(self.page_num):
-            result = requests.get(url)
-            soup = BeautifulSoup(result.content, "lxml")
-            img_url = soup.find("span", {"id": "imgarea"}).find("a").find("img")["src"]
-            url = (
-                self.base_url
-                + soup.find("div", {"class": "newpage"}).find_all("a")[-1]["href"]
-            )
-            yield img_url
-
-    def _download_list(self, iter_list):
-        """
-        Download files in the list.
-        """
-        new_folder = os.path.join(self._base_path_modifier(), self.title)
-        img_list = []
-        with click.progressbar(iter_list, length=self.page_num) as bar:
-            for index, url in enumerate(bar):
-                # TODO may need better url generator since it may change.
-                file_url = "https:" + url
-                r = requests.get(file_url)
-                if r.status_code == 404:
-                    if file_url.split(".")[-1] == "jpg":
-                        file_url = file_url.replace("jpg", "png")
-                    else:
-                        file_url = file_url.replace("png", "jpg")
-                    r = requests.get(file_url)
-                elif r.status_code == 200:
-                    img_name = str(index) + "." + file_url.split(".")[-1]
-                    try:
-                        img = Image.open(BytesIO(r.content))
-                        img.save(new_folder + "/" + img_name)
-                        img_list.append(img_name)
-                    except OSError:
-                        print(file_url + "  cannot be saved.")
-                else:
-                    pass
-        # generate cbz file
-        os.chdir(new_folder)
-        zipf = zipfile.ZipFile(f"{self.title}.cbz", "w", zipfile.ZIP_DEFLATED)
-        for img in img_list:
-            zipf.write(img, compress_type=zipfile.ZIP_DEFLATED)
-        zipf.close()
+            result = self._get(url)
+            doc = _parse(result)
+            img_url = _XPATH_IMGAREA(doc)[0]
+            page_url = url
+            url = self.base_url + _XPATH_NEXT_PAGE(doc)[-1]
+            yield img_url, page_url
+
+    def _download_image(self, index, url, referer):
+        """
+        Download a single image, sending the page showing it as referer.
+
+        Return the image name and its bytes, also saved in the new folder
+        unless only the cbz file is kept.
+        """
+        stem, _, ext = ("https:" + url).rpartition(".")
+        # albums are usually in one format, start generated urls with the one
+        # found last, crawled urls come from the page and are used as they are
+        if self.mode != "crawl" and ext in self.ALTERNATE_EXT and self._preferred_ext:
+            ext = self._preferred_ext
+        headers = {"Referer": referer}
+        request_headers = headers
+        cached = self._cached(url)
+        if cached:
+            # saved by an earlier run, only sent again when it changed
+            ext = cached[0].rpartition(".")[2]
+            request_headers = dict(headers, **cached[1])
+        r = self._get(stem + "." + ext, stream=True, headers=request_headers)
+        if r.status_code == 304 and cached:
+            r.close()
+            with open(os.path.join(self.new_folder, cached[0]), "rb") as f:
+                return cached[0], f.read()
+        if r.status_code == 404 and ext in self.ALTERNATE_EXT:
+            r.close()
+            ext = self.ALTERNATE_EXT[ext]
+            if self._probe(stem + "." + ext, headers) != 200:
+                return None
+            r = self._get(stem + "." + ext, stream=True, headers=headers)
+        with r:
+            if r.status_code != 200:
+                return None
+            if ext in self.ALTERNATE_EXT:
+                self._preferred_ext = ext
+            img_name = str(index) + "." + ext
+            path = os.path.join(self.new_folder, img_name)
+            try:
+                buf = BytesIO()
+                self._save_image(r, buf, ext)
+                if not self.zip_only:
+                    with open(path, "wb") as f:
+                        f.write(buf.getbuffer())
+                    with self._manifest_lock:
+                        self._manifest[url] = {
+                            "name": img_name,
+                            "etag": r.headers.get("ETag"),
+                            "last_modified": r.headers.get("Last-Modified"),
+                        }
+                # a view on the buffer, the image bytes are not copied again
+                return img_name, buf.getbuffer()
+            except (OSError, KeyError):
+                print(stem + "." + ext + "  cannot be saved.")
+                if os.path.exists(path):
+                    os.remove(path)
+        return None
+
+    def _queue_downloads(self, iter_list, executor, futures, stop):
+        """
+        Submit the download of each (url, referer) as soon as it is known.
+
+        The futures are put in order in the queue, followed by None, or by
+        the exception raised while producing the urls. Nothing more is
+        submitted once stop is set.
+        """
+        try:
+            for index, (url, referer) in enumerate(iter_list):
+                future = executor.submit(self._download_image, index, url, referer)
+                if not _put_unless_stopped(futures, future, stop):
+                    future.cancel()
+                    return
+            _put_unless_stopped(futures, None, stop)
+        except Exception as err:  # pylint: disable=broad-except
+            _put_unless_stopped(futures, err, stop)
+        finally:
+            # a crawl stopped half way lets go of its page generator now
+            close = getattr(iter_list, "close", None)
+            if close is not None:
+                close()
+
+    def _download_list(self, iter_list, length):
+        """
+        Download files in the list into the new folder.
+        """
+        cbz_path = os.path.join(self.new_folder, f"{self.title}.cbz")
+        # bounded so that finished downloads never pile up in memory
+        futures = queue.Queue(maxsize=self.QUEUE_SIZE)
+        stop = threading.Event()
+        # images are already compressed, deflating them again gains nothing
+        with zipfile.ZipFile(cbz_path, "w", zipfile.ZIP_STORED) as zipf:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                # the urls are produced while the images download, crawling
+                # the next page overlaps with fetching the previous images
+                producer = threading.Thread(
+                    target=self._queue_downloads,
+                    args=(iter_list, executor, futures, stop),
+                    daemon=True,
+                )
+                producer.start()
+                try:
+                    self._archive(futures, zipf, length)
+                finally:
+                    # when archiving failed, stop the producer before the
+                    # executor shuts down and drop the downloads not started
+                    stop.set()
+                    producer.join()
+                    while not futures.empty():
+                        future = futures.get_nowait()
+                        if isinstance(future, Future):
+                            future.cancel()
+
+    def _archive(self, futures, zipf, length):
+        """
+        Write the image of each queued future into the cbz file, in order.
+        """
+        # repaint the bar about every percent, not for every image
+        step = max(1, length // 100)
+        done = 0
+        with click.progressbar(length=length) as bar:
+            for future in iter(futures.get, None):
+                if isinstance(future, Exception):
+                    raise future
+                try:
+                    img = future.result()
+                except requests.RequestException as err:
+                    print(f"An image cannot be downloaded: {err}")
+                    img = None
+                done += 1
+                if done % step == 0:
+                    bar.update(step)
+                if img is None:
+                    continue
+                # the bytes go in as they are, never read back from disk
+                zipf.writestr(*img)
+            bar.update(done % step)
 
     def download(self):
         """
         Download images.
         """
-        new_folder = os.path.join(self._base_path_modifier(), self.title)
+        os.makedirs(self.new_folder, mode=0o755, exist_ok=True)
+        if not self.zip_only:
+            self._load_manifest()
         try:
-            os.makedirs(new_folder, mode=0o755, exist_ok=True)
-        except OSError:
-            pass
+            self._download_all()
+        finally:
+            # also kept when interrupted, the next run resumes from there
+            if not self.zip_only:
+                self._save_manifest()
+
+    def _download_all(self):
+        """
+        Download the images of every naming rule, or crawl the pages for them.
+        """
         # handle normal image naming rules
         if self.mode == "crawl":
-            self._download_list(self._page_crawl(self.img_link))
+            self._download_list(self._page_crawl(self.img_link), self.page_num)
         else:
             url_parsed = URLProcessor(self.data_url, self.page_num)
-            self._download_list(url_parsed.normal_url_list())
-            self._download_list(url_parsed.special_url_list())
-            self._download_list(url_parsed.special_url_list(sep="-"))
-            self._download_list(url_parsed.special_url_list(sep="_"))
+            # one pass over every naming rule so the cbz holds all of them
+            urls = chain(
+                url_parsed.normal_url_list(),
+                url_parsed.special_url_list(),
+                url_parsed.special_url_list(sep="-"),
+                url_parsed.special_url_list(sep="_"),
+            )
+            # the image pages are unknown, the site itself is the referer
+            urls = [(url, self.base_url) for url in dict.fromkeys(urls)]
+            self._download_list(urls, len(urls))
+
+
+def batch_download(urls, base_path, mode, concurrency=3, **kwargs):
+    """
+    Download the albums of several urls at the same time over one session.
+
+    The grabbers built are returned, the ones with an invalid url are not
+    downloaded. An error with one url is reported and the others go on.
+    """
+    grabbers = []
+    connection = None
+    try:
+        # one after the other, the first grabber opens the connection for all
+        for url in urls:
+            try:
+                grabber = ImageGrabber(
+                    url, base_path, mode, connection=connection, **kwargs
+                )
+            except Exception as err:  # pylint: disable=broad-except
+                print(f"{url} cannot be opened: {err}")
+                continue
+            connection = grabber.connection
+            grabbers.append(grabber)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {
+                executor.submit(grabber.download): grabber
+                for grabber in grabbers
+                if grabber.valid
+            }
+            for future, grabber in futures.items():
+                try:
+                    future.result()
+                except Exception as err:  # pylint: disable=broad-except
+                    print(f"{grabber.url} cannot be downloaded: {err}")
+    finally:
+        # the sessions replaced after refusals are already closed
+        if connection is not None:
+            connection.session.close()
+    return grabbers
@@ -10,6 +10,10 @@ import re
 LC_LIST = ["a", "b", "c", "d", "e", "f", "g"]
 CAP_LIST = ["A", "B", "C", "D", "E", "F", "G"]
 NUM_LIST = ["0", "1", "2", "3", "4", "5", "6"]
+# every character a special url may end with, in the order they are tried
+SP_C_LIST = tuple(LC_LIST + CAP_LIST + NUM_LIST)
+
+_DIGITS_RE = re.compile(r"\d+")
 
 
 class URLProcessor(object):
@@ -30,48 +34,51 @@ class URLProcessor(object):
         """
         Generate the template string from url.
         """
-        fn = url.split("/")[-1]
-        str_to_replaced = re.findall(r"\d+", fn)
-        self.num_vars = len(str_to_replaced)
-        self.n_digits = [len(s) for s in str_to_replaced]
-        rep = {}
-        for index, item in enumerate(str_to_replaced):
-            rep[item] = "{var%i}" % index
-        # use these three lines to do the replacement
-        rep = dict((re.escape(k), v) for k, v in rep.items())
-        pattern = re.compile("|".join(rep.keys()))
-        text = pattern.sub(lambda m: rep[re.escape(m.group(0))], url)
-        return text
+        # only the digits of the file name are numbering, one scan over it
+        # splits the url into the literal segments around them, which build
+        # the urls without formatting the template
+        start = url.rfind("/") + 1
+        self._segments = []
+        self.n_digits = []
+        last = 0
+        for m in _DIGITS_RE.finditer(url, start):
+            self._segments.append(url[last : m.start()])
+            self.n_digits.append(m.end() - m.start())
+            last = m.end()
+        self._segments.append(url[last:])
+        self.num_vars = len(self.n_digits)
+        placeholders = ["{var%i}" % t for t in range(self.num_vars)]
+        return "".join(self._join(placeholders))
+
+    def _join(self, numbers):
+        """
+        Interleave the literal segments with the numbers.
+        """
+        parts = [None] * (2 * self.num_vars + 1)
+        parts[::2] = self._segments
+        parts[1::2] = numbers
+        return parts
 
     def normal_url_list(self):
         """
         Generate normal url list for iteration.
         """
+        parts = self._join([None] * self.num_vars)
         for i in range(0, self.pnum + 1):
-            rep_dict = {
-                "var%i" % t: str(i).zfill(self.n_digits[t])
-                for t in range(self.num_vars)
-            }
-            yield self.template.format(**rep_dict)
+            num = str(i)
+            parts[1::2] = [num.zfill(width) for width in self.n_digits]
+            yield "".join(parts)
 
     def special_url_list(self, sep=""):
         """
         Generate special urls for iteration.
         """
-        sp_c_list = LC_LIST + CAP_LIST + NUM_LIST
-        for c in sp_c_list:
-            if sep:
-                rep_dict = {
-                    "var%i" % t: "0".zfill(self.n_digits[t])
-                    if t < self.num_vars - 1
-                    else "0".zfill(self.n_digits[t]) + sep + c
-                    for t in range(self.num_vars)
-                }
-            else:
-                rep_dict = {
-                    "var%i" % t: "0".zfill(self.n_digits[t])
-                    if t < self.num_vars - 1
-                    else "0".zfill(self.n_digits[t]) + c
-                    for t in range(self.num_vars)
-                }
-            yield self.template.format(**rep_dict)
+        if not self.num_vars:
+            # no number to put the character after
+            return
+        # only the character changes, the rest is joined once
+        parts = self._join(["0".zfill(width) for width in self.n_digits])
+        prefix = "".join(parts[:-1]) + sep
+        suffix = parts[-1]
+        for c in SP_C_LIST:
+            yield prefix + c + suffix